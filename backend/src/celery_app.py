@@ -1,4 +1,5 @@
 from celery import Celery
+from celery.schedules import crontab
 import os
 
 # 讀取環境變數 (與 config.py 邏輯類似，但這裡簡單處理以避免循環引用)
@@ -18,4 +19,16 @@ celery_app.conf.update(
     result_serializer="json",
     timezone="Asia/Taipei",
     enable_utc=True,
+    # 封存任務走獨立的 maintenance queue，避免佔用 AI Worker 導致檢測任務逾時被丟棄
+    task_routes={
+        "compact_storage_task": {"queue": "maintenance"},
+    },
+    # 定期排程 (由 maintenance-worker 以 -B 內嵌 celery beat 觸發)
+    beat_schedule={
+        # 每天凌晨把舊影像打包成 Shard 並套用保留策略
+        "compact-raw-images": {
+            "task": "compact_storage_task",
+            "schedule": crontab(hour=3, minute=0),
+        },
+    },
 )
\ No newline at end of file
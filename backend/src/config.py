@@ -8,6 +8,16 @@ class Settings(BaseSettings):
     MINIO_USER: str
     MINIO_PASSWORD: str
     MINIO_BUCKET_NAME: str = "raw-images"
+    # 封存 (Compaction) 設定：把舊的單張影像打包成大型 Shard 檔
+    MINIO_SHARD_BUCKET_NAME: str = "raw-shards"
+    COMPACTION_MIN_AGE_HOURS: int = 24            # 超過此時數且已檢測完成的影像才會被打包
+    COMPACTION_SHARD_TARGET_BYTES: int = 256 * 1024 * 1024  # 單一 Shard 目標大小
+    COMPACTION_BATCH_SIZE: int = 500              # 每次從 DB 撈取的筆數
+    COMPACTION_CHECKPOINT_MARGIN_MINUTES: int = 30  # 多 Worker 時 id 與 created_at 順序可能不一致，進度只推進到 cutoff 前這段時間
+    # 保留策略 (Retention)：可選 keep / drop / downsample，瑕疵與良品影像分開設定
+    RETENTION_DEFECT_POLICY: str = "keep"
+    RETENTION_CLEAN_POLICY: str = "downsample"
+    RETENTION_SAMPLE_EVERY: int = 10              # downsample 時每 N 張保留 1 張
     class Config:
         # 指定 .env 檔案位置 (相對於執行目錄)
         env_file = ".env"
@@ -1,11 +1,16 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, Query, HTTPException
+from fastapi.responses import StreamingResponse
+from sqlalchemy import tuple_, exists
+from typing import Optional
+from datetime import datetime
+import base64
 from .services.storage import get_storage_client
 from .config import settings
 import uuid
 from .tasks import detect_image_task  # 新增: 匯入任務函式
 from celery.result import AsyncResult
 from .celery_app import celery_app
-from .models import SessionLocal, InspectionResult
+from .models import SessionLocal, InspectionResult, InspectionDetection
 import json
 import time
 from prometheus_fastapi_instrumentator import Instrumentator # 新增
@@ -38,7 +43,7 @@ def health_check():
     return {"status": "ok", "service": "Sentinel-AOI Backend"}
 
 @app.post("/api/v1/detect")
-async def upload_and_detect(file: UploadFile = File(...)):
+async def upload_and_detect(file: UploadFile = File(...), line: Optional[str] = Form(None)):
     """
     模擬產線接口：
     1. 接收圖片
@@ -61,7 +66,7 @@ async def upload_and_detect(file: UploadFile = File(...)):
         storage_path = storage_client.upload_file(file_content, unique_filename, file.content_type)
         # 發送非同步任務到 Celery 
         # .delay() 會將任務丟進 Redis 就立刻回傳，不會卡住
-        task = detect_image_task.delay(unique_filename, storage_path, time.time())
+        task = detect_image_task.delay(unique_filename, storage_path, time.time(), line)
         return {
             "status": "received",
             "task_id": task.id,  # 回傳任務 ID 供前端查詢
@@ -97,3 +102,152 @@ def get_result(task_id: str):
             }
     # 狀態 3: 失敗
     return {"status": "failed", "error": str(task_result.result)}
+
+# 歷史查詢可回傳的欄位 (inference_result 較大，預設不回傳)
+INSPECTION_FIELDS = {
+    "id": InspectionResult.id,
+    "task_id": InspectionResult.task_id,
+    "filename": InspectionResult.filename,
+    "storage_path": InspectionResult.storage_path,
+    "line": InspectionResult.line,
+    "inference_result": InspectionResult.inference_result,
+    "created_at": InspectionResult.created_at,
+}
+DEFAULT_INSPECTION_FIELDS = ["id", "task_id", "filename", "line", "created_at"]
+NDJSON_CHUNK_SIZE = 1000
+
+def _encode_cursor(created_at: datetime, record_id: int) -> str:
+    raw = f"{created_at.isoformat()}|{record_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def _decode_cursor(cursor: str):
+    try:
+        created_at, record_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), int(record_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def _serialize_inspection(row, fields: list) -> dict:
+    item = {}
+    for name in fields:
+        value = getattr(row, name)
+        if name == "created_at" and value is not None:
+            value = value.isoformat()
+        elif name == "inference_result" and isinstance(value, str):
+            value = json.loads(value)
+        item[name] = value
+    return item
+
+def _label_match_query(db, criteria: dict, after, limit: int):
+    """
+    依類別查詢時，從 inspection_detections 的 (label, created_at, inspection_id) 索引
+    以相同的 keyset 條件找出符合的紀錄 id (同一張影像多個相同類別只算一次)。
+    """
+    query = db.query(InspectionDetection.created_at, InspectionDetection.inspection_id).filter(
+        InspectionDetection.label == criteria["label"]
+    )
+    if criteria["min_confidence"] is not None:
+        query = query.filter(InspectionDetection.confidence >= criteria["min_confidence"])
+    if criteria["since"] is not None:
+        query = query.filter(InspectionDetection.created_at >= criteria["since"])
+    if criteria["until"] is not None:
+        query = query.filter(InspectionDetection.created_at < criteria["until"])
+    if criteria["line"] is not None:
+        query = query.filter(InspectionDetection.line == criteria["line"])
+    if after is not None:
+        query = query.filter(tuple_(InspectionDetection.created_at, InspectionDetection.inspection_id) < tuple_(*after))
+    return (
+        query.distinct()
+        .order_by(InspectionDetection.created_at.desc(), InspectionDetection.inspection_id.desc())
+        .limit(limit)
+    )
+
+def _query_inspection_page(db, fields: list, criteria: dict, after, limit: int):
+    """
+    Keyset 分頁：以 (created_at, id) 由新到舊排序，
+    用上一頁最後一筆當作條件 (而非 OFFSET)，深頁延遲維持固定。
+    """
+    # created_at 與 id 一定要撈，才能產生下一頁的 cursor
+    columns = [INSPECTION_FIELDS[name] for name in dict.fromkeys(fields + ["created_at", "id"])]
+    query = db.query(*columns)
+    if criteria["label"] is not None:
+        # 其餘條件都已在子查詢中套用，這裡只需取回對應的紀錄
+        matched = _label_match_query(db, criteria, after, limit).subquery()
+        query = query.join(matched, matched.c.inspection_id == InspectionResult.id)
+    else:
+        if criteria["since"] is not None:
+            query = query.filter(InspectionResult.created_at >= criteria["since"])
+        if criteria["until"] is not None:
+            query = query.filter(InspectionResult.created_at < criteria["until"])
+        if criteria["line"] is not None:
+            query = query.filter(InspectionResult.line == criteria["line"])
+        if criteria["min_confidence"] is not None:
+            query = query.filter(exists().where(
+                InspectionDetection.inspection_id == InspectionResult.id,
+                InspectionDetection.confidence >= criteria["min_confidence"]
+            ))
+        if after is not None:
+            query = query.filter(tuple_(InspectionResult.created_at, InspectionResult.id) < tuple_(*after))
+    return (
+        query.order_by(InspectionResult.created_at.desc(), InspectionResult.id.desc())
+        .limit(limit)
+        .all()
+    )
+
+# 歷史檢測紀錄查詢 (給儀表板與 MES 串接)
+@app.get("/api/v1/inspections")
+def list_inspections(
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    label: Optional[str] = None,
+    min_confidence: Optional[float] = Query(None, ge=0.0, le=1.0),
+    line: Optional[str] = None,
+    fields: Optional[str] = Query(None, description="以逗號分隔的欄位，例如 id,filename,inference_result"),
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=500),
+    output_format: str = Query("json", alias="format", pattern="^(json|ndjson)$")
+):
+    """
+    分頁查詢檢測紀錄：
+    - 篩選：時間區間 (since / until)、瑕疵類別、最低信心度 (兩者同時指定時需為同一個偵測結果)、產線
+    - 分頁：回傳 next_cursor，帶入下一次請求的 cursor 參數
+    - format=ndjson：從 cursor 開始串流所有符合條件的紀錄 (大量匯出用，忽略 limit)
+    """
+    selected = [name.strip() for name in fields.split(",") if name.strip()] if fields else DEFAULT_INSPECTION_FIELDS
+    unknown = [name for name in selected if name not in INSPECTION_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    criteria = {"since": since, "until": until, "label": label, "min_confidence": min_confidence, "line": line}
+    after = _decode_cursor(cursor) if cursor else None
+
+    if output_format == "ndjson":
+        def stream():
+            # 串流時分批撈取，每批都用 keyset 接續，避免一次載入整張表
+            db = SessionLocal()
+            try:
+                position = after
+                while True:
+                    rows = _query_inspection_page(db, selected, criteria, position, NDJSON_CHUNK_SIZE)
+                    for row in rows:
+                        yield json.dumps(_serialize_inspection(row, selected), ensure_ascii=False) + "\n"
+                    if len(rows) < NDJSON_CHUNK_SIZE:
+                        break
+                    position = (rows[-1].created_at, rows[-1].id)
+            finally:
+                db.close()
+        return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+    db = SessionLocal()
+    try:
+        # 多撈一筆判斷是否還有下一頁
+        rows = _query_inspection_page(db, selected, criteria, after, limit + 1)
+    finally:
+        db.close()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(rows[-1].created_at, rows[-1].id)
+    return {
+        "items": [_serialize_inspection(row, selected) for row in rows],
+        "next_cursor": next_cursor
+    }
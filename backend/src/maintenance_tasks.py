@@ -0,0 +1,13 @@
+from .celery_app import celery_app
+from .services.storage import get_storage_client
+from .services.compaction import compact_raw_images
+
+# 維運任務獨立成一個模組：maintenance-worker 只需載入這裡，不必載入 YOLO 模型
+
+@celery_app.task(name="compact_storage_task")
+def compact_storage_task():
+    """背景封存：把舊影像打包成 Shard 並套用保留策略，回傳回收的物件數與空間"""
+    storage_client = get_storage_client()
+    if not storage_client:
+        raise Exception("MinIO connection failed")
+    return compact_raw_images(storage_client)
@@ -0,0 +1,81 @@
+"""
+一次性升級既有資料庫 (歷史查詢 API 所需的索引，並回填偵測結果)。
+新欄位由啟動時的 init_db() 補上；這裡只做較耗時、不適合在啟動時跑的步驟。
+在 backend 目錄執行：python -m src.migrations
+可重複執行；新建的資料庫由 init_db() 直接建好，不需要執行這支程式。
+"""
+from sqlalchemy import text
+import json
+from .models import engine, SessionLocal, InspectionResult, InspectionDetection, init_db
+
+BACKFILL_BATCH_SIZE = 1000
+
+def create_indexes_concurrently():
+    """
+    用 CREATE INDEX CONCURRENTLY 補建索引，建立期間不會鎖住 Worker 的寫入。
+    CONCURRENTLY 不能在 transaction 內執行，所以使用 AUTOCOMMIT 連線。
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        # 上次中斷的 CONCURRENTLY 會留下 INVALID 索引，IF NOT EXISTS 會跳過它，先刪掉重建
+        invalid = set(conn.execute(text(
+            "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE NOT i.indisvalid"
+        )).scalars())
+        for table in (InspectionResult.__table__, InspectionDetection.__table__):
+            for index in table.indexes:
+                if index.name in invalid:
+                    print(f"Dropping invalid index {index.name}")
+                    conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {index.name}"))
+                columns = ", ".join(column.name for column in index.columns)
+                print(f"Creating index {index.name} ({columns})...")
+                conn.execute(text(
+                    f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index.name} ON {table.name} ({columns})"
+                ))
+
+def backfill_detections(session_factory=SessionLocal) -> int:
+    """從 inference_result 回填 inspection_detections，讓舊資料也能依類別 / 信心度查詢。回傳新增筆數"""
+    inserted = 0
+    last_id = 0
+    db = session_factory()
+    try:
+        while True:
+            # 以 id 做 keyset 分批；已有偵測結果的紀錄 (Worker 新寫入或上次已回填) 直接略過
+            rows = (
+                db.query(InspectionResult.id, InspectionResult.inference_result, InspectionResult.created_at, InspectionResult.line)
+                .filter(
+                    InspectionResult.id > last_id,
+                    ~InspectionResult.detections.any()
+                )
+                .order_by(InspectionResult.id)
+                .limit(BACKFILL_BATCH_SIZE)
+                .all()
+            )
+            if not rows:
+                break
+            for record_id, inference_result, created_at, line in rows:
+                last_id = record_id
+                detections = json.loads(inference_result) if isinstance(inference_result, str) else (inference_result or [])
+                for detection in detections:
+                    db.add(InspectionDetection(
+                        inspection_id=record_id,
+                        label=detection["label"],
+                        confidence=detection["confidence"],
+                        created_at=created_at,
+                        line=line
+                    ))
+                    inserted += 1
+            db.commit()
+            print(f"Backfilled detections up to inspection id {last_id}")
+    finally:
+        db.close()
+    return inserted
+
+def main():
+    print("Creating new tables and columns...")
+    init_db()
+    create_indexes_concurrently()
+    print("Backfilling detections...")
+    inserted = backfill_detections()
+    print(f"Migration complete ({inserted} detections backfilled).")
+
+if __name__ == "__main__":
+    main()
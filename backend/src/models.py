@@ -1,6 +1,6 @@
-from sqlalchemy import Column, Integer, String, JSON, DateTime, create_engine
+from sqlalchemy import Column, Integer, BigInteger, String, Float, JSON, DateTime, ForeignKey, Index, create_engine, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, relationship
 from datetime import datetime
 import os
 
@@ -22,6 +22,66 @@ class InspectionResult(Base):
     storage_path = Column(String)             # MinIO 路徑
     inference_result = Column(JSON)           # YOLO 偵測到的座標與類別
     created_at = Column(DateTime, default=datetime.utcnow)
+    line = Column(String, nullable=True)      # 產線代號
+    # 每個偵測結果一筆，供依類別 / 信心度篩選
+    detections = relationship("InspectionDetection", cascade="all, delete-orphan")
+    # 複合索引：支援 (created_at, id) Keyset 分頁，以及依產線篩選後分頁
+    # 既有資料表請用 python -m src.migrations 補建 (CONCURRENTLY，不鎖寫入)
+    __table_args__ = (
+        Index("ix_inspection_results_created_at_id", "created_at", "id"),
+        Index("ix_inspection_results_line_created_at_id", "line", "created_at", "id"),
+    )
+# 定義 "偵測結果" 資料表 (inference_result 拆成每個 bbox 一筆)
+class InspectionDetection(Base):
+    __tablename__ = "inspection_detections"
+    id = Column(Integer, primary_key=True)
+    inspection_id = Column(Integer, ForeignKey("inspection_results.id", ondelete="CASCADE"), nullable=False)
+    label = Column(String, nullable=False)    # 瑕疵類別
+    confidence = Column(Float, nullable=False)
+    # 與 InspectionResult 相同的值 (反正規化)，讓依類別查詢可直接在這張表上做 keyset 分頁
+    created_at = Column(DateTime, nullable=False)
+    line = Column(String, nullable=True)
+    __table_args__ = (
+        # 依類別查詢：由這個索引依 (created_at, inspection_id) 由新到舊走訪，深頁延遲維持固定
+        Index("ix_inspection_detections_label_created_at_inspection_id", "label", "created_at", "inspection_id"),
+        # 只指定 min_confidence 時的 EXISTS 子查詢 (以及回填時判斷是否已有偵測結果)
+        Index("ix_inspection_detections_inspection_id_label_confidence", "inspection_id", "label", "confidence"),
+    )
+# 定義 "Shard 索引" 資料表 (封存後 storage_path -> Shard 內的 offset / length)
+class FrameShardIndex(Base):
+    __tablename__ = "frame_shard_index"
+    id = Column(Integer, primary_key=True, index=True)
+    storage_path = Column(String, unique=True, index=True)  # 對應 InspectionResult.storage_path
+    status = Column(String, default="packed")               # packed: 已打包 / dropped: 依保留策略刪除 / missing: 封存時原始物件已不存在
+    shard_path = Column(String, nullable=True)              # Shard 路徑 (bucket/object)，僅 packed 有值
+    offset = Column(BigInteger, nullable=True)              # 影像在 Shard 內的起始位置
+    length = Column(BigInteger)                             # 影像大小 (bytes)
+    content_type = Column(String, nullable=True)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+# 定義 "封存進度" 資料表 (記錄已掃描到的 InspectionResult.id，下次從這裡接續)
+class CompactionCheckpoint(Base):
+    __tablename__ = "compaction_checkpoints"
+    name = Column(String, primary_key=True)
+    last_id = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+def add_missing_columns(bind=engine):
+    """
+    補上既有 inspection_results 缺少的欄位 (create_all 不會修改既有資料表)。
+    只新增 nullable 且無預設值的欄位，PostgreSQL 只改 metadata，不會重寫整張表，可以在啟動時執行。
+    """
+    existing = {column["name"] for column in inspect(bind).get_columns("inspection_results")}
+    if "line" in existing:
+        return
+    with bind.begin() as conn:
+        if bind.dialect.name == "postgresql":
+            # ALTER 需要短暫的排他鎖：拿不到就放棄，不要卡住 Worker 的寫入 (下次啟動再試)
+            conn.execute(text("SET LOCAL lock_timeout = '5s'"))
+            # 多個 uvicorn worker 同時啟動時可能重複執行
+            conn.execute(text("ALTER TABLE inspection_results ADD COLUMN IF NOT EXISTS line VARCHAR"))
+        else:
+            conn.execute(text("ALTER TABLE inspection_results ADD COLUMN line VARCHAR"))
 # 自動建表 (簡單起見，直接在這裡執行)
+# 索引的 CONCURRENTLY 建立與資料回填較耗時，放在 python -m src.migrations
 def init_db():
-    Base.metadata.create_all(bind=engine)
\ No newline at end of file
+    Base.metadata.create_all(bind=engine)
+    add_missing_columns()
@@ -0,0 +1,228 @@
+from minio.error import S3Error
+from datetime import datetime, timedelta
+import io
+import json
+import tempfile
+import uuid
+from ..config import settings
+from ..models import SessionLocal, InspectionResult, FrameShardIndex, CompactionCheckpoint
+
+RETENTION_POLICIES = ("keep", "drop", "downsample")
+CHECKPOINT_NAME = "raw-images"
+
+def is_defect(record) -> bool:
+    """有任何偵測結果就視為瑕疵影像"""
+    detections = record.inference_result
+    if isinstance(detections, str):
+        detections = json.loads(detections)
+    return bool(detections)
+
+def should_retain(record, policy: str, sample_every: int) -> bool:
+    """依保留策略決定這張影像要不要留下"""
+    if policy == "keep":
+        return True
+    if policy == "drop":
+        return False
+    if policy == "downsample":
+        # 以 DB id 取樣，重跑時結果不變
+        return record.id % max(sample_every, 1) == 0
+    raise ValueError(f"Unknown retention policy: {policy} (expected one of {RETENTION_POLICIES})")
+
+class ShardWriter:
+    """
+    把多張小影像依序寫進同一個 Shard (append-only)，並記錄每張影像的 offset。
+    寫滿後一次上傳 Shard 本體 (.bin) 與索引檔 (.idx.json)。
+    """
+    def __init__(self, storage, bucket_name: str):
+        self.storage = storage
+        self.bucket_name = bucket_name
+        self.object_name = f"shard-{datetime.utcnow():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}.bin"
+        # 小於 64MB 時留在記憶體，超過才落地成暫存檔
+        self.buffer = tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024)
+        self.entries = []
+        self.size = 0
+
+    @property
+    def shard_path(self) -> str:
+        return f"{self.bucket_name}/{self.object_name}"
+
+    def append(self, storage_path: str, data: bytes, content_type: str):
+        self.entries.append({
+            "storage_path": storage_path,
+            "offset": self.size,
+            "length": len(data),
+            "content_type": content_type
+        })
+        self.buffer.write(data)
+        self.size += len(data)
+
+    def flush(self):
+        """上傳 Shard 與索引檔，回傳寫入的物件數"""
+        self.buffer.seek(0)
+        self.storage.client.put_object(
+            bucket_name=self.bucket_name,
+            object_name=self.object_name,
+            data=self.buffer,
+            length=self.size,
+            content_type="application/octet-stream"
+        )
+        self.buffer.close()
+        # 索引檔讓 Shard 可以脫離 DB 自我描述 (備份 / 資料集匯出用)
+        index_data = json.dumps(self.entries, ensure_ascii=False).encode("utf-8")
+        self.storage.client.put_object(
+            bucket_name=self.bucket_name,
+            object_name=self.object_name.replace(".bin", ".idx.json"),
+            data=io.BytesIO(index_data),
+            length=len(index_data),
+            content_type="application/json"
+        )
+        return 2
+
+def compact_raw_images(storage, session_factory=SessionLocal, now: datetime = None) -> dict:
+    """
+    封存 + 保留策略：
+    1. 從上次的進度 (CompactionCheckpoint) 接續，找出超過 COMPACTION_MIN_AGE_HOURS 且尚未封存的檢測紀錄
+    2. 依保留策略決定丟棄或打包進 Shard
+    3. Shard 上傳且索引寫入 DB 後，才刪除原始小物件
+    回傳處理統計 (物件數、回收空間、刪除失敗的路徑)。
+    """
+    for policy in (settings.RETENTION_DEFECT_POLICY, settings.RETENTION_CLEAN_POLICY):
+        if policy not in RETENTION_POLICIES:
+            raise ValueError(f"Unknown retention policy: {policy} (expected one of {RETENTION_POLICIES})")
+    now = now or datetime.utcnow()
+    cutoff = now - timedelta(hours=settings.COMPACTION_MIN_AGE_HOURS)
+    # id 由 DB sequence 產生、created_at 由各 Worker 寫入，兩者順序可能有些微落差；
+    # 進度只推進到 created_at < safe_cutoff 的 id，避免較小 id 但較晚 created_at 的紀錄被永久跳過
+    safe_cutoff = cutoff - timedelta(minutes=settings.COMPACTION_CHECKPOINT_MARGIN_MINUTES)
+    storage._ensure_bucket_exists(settings.MINIO_SHARD_BUCKET_NAME)
+    report = {
+        "frames_scanned": 0,
+        "frames_packed": 0,
+        "frames_dropped": 0,
+        "frames_missing": 0,
+        "shards_written": 0,
+        "objects_removed": 0,
+        "objects_created": 0,
+        "bytes_packed": 0,
+        "bytes_reclaimed": 0,
+        "remove_failed": []
+    }
+    # Shard flush 會在批次中途 commit，關掉 expire_on_commit 以免剩下的 record 逐筆重新 SELECT
+    db = session_factory(expire_on_commit=False)
+    writer = None
+    writer_first_id = None  # 目前 Shard 中最小的 record id (尚未寫入索引)
+
+    def remove_raw(paths: list) -> list:
+        # 刪除失敗重試一次，仍失敗的列在報表中 (索引已寫入，之後的封存不會再掃到它們)
+        failed = storage.remove_files(paths) if paths else []
+        if failed:
+            failed = storage.remove_files(failed)
+        report["objects_removed"] += len(paths) - len(failed)
+        report["remove_failed"].extend(failed)
+        return failed
+
+    def save_checkpoint(last_id: int):
+        # Shard 內尚未寫入索引的影像不能算進度，否則中途失敗會被永久跳過
+        last_id = min(last_id, safe_id)
+        if writer_first_id is not None:
+            last_id = min(last_id, writer_first_id - 1)
+        checkpoint.last_id = max(checkpoint.last_id, last_id)
+
+    def flush_shard():
+        # 順序很重要：Shard 上傳 -> 索引 commit -> 刪除原始物件
+        # 中途失敗最多留下孤兒 Shard 或未刪除的原始物件，不會讓 storage_path 失效
+        report["objects_created"] += writer.flush()
+        for entry in writer.entries:
+            db.add(FrameShardIndex(status="packed", shard_path=writer.shard_path, **entry))
+        db.commit()
+        remove_raw([entry["storage_path"] for entry in writer.entries])
+        report["shards_written"] += 1
+        print(f"📦 [Compaction] Shard 完成: {writer.shard_path} ({len(writer.entries)} 張, {writer.size} bytes)")
+
+    try:
+        checkpoint = db.get(CompactionCheckpoint, CHECKPOINT_NAME)
+        if checkpoint is None:
+            checkpoint = CompactionCheckpoint(name=CHECKPOINT_NAME, last_id=0)
+            db.add(checkpoint)
+        last_id = checkpoint.last_id
+        safe_id = last_id  # 已掃描且 created_at < safe_cutoff 的最大 id
+        while True:
+            # 以 id 做 keyset 分頁，且只掃進度之後的紀錄，成本不隨歷史資料量成長
+            batch = (
+                db.query(InspectionResult)
+                .outerjoin(FrameShardIndex, FrameShardIndex.storage_path == InspectionResult.storage_path)
+                .filter(
+                    FrameShardIndex.id.is_(None),
+                    InspectionResult.created_at < cutoff,
+                    InspectionResult.id > last_id
+                )
+                .order_by(InspectionResult.id)
+                .limit(settings.COMPACTION_BATCH_SIZE)
+                .all()
+            )
+            if not batch:
+                break
+            dropped_sizes = {}  # storage_path -> bytes，刪除成功才算回收
+            # 同一張影像可能對應多筆紀錄 (例如任務重試)：已提交的由索引的 unique 排除，
+            # 這裡只需檢查本批次與目前 Shard 內尚未提交的路徑
+            pending = {entry["storage_path"] for entry in writer.entries} if writer else set()
+            for record in batch:
+                last_id = record.id
+                if record.created_at < safe_cutoff:
+                    safe_id = record.id
+                if record.storage_path in pending:
+                    continue
+                pending.add(record.storage_path)
+                report["frames_scanned"] += 1
+                bucket_name, object_name = record.storage_path.split("/", 1)
+                policy = settings.RETENTION_DEFECT_POLICY if is_defect(record) else settings.RETENTION_CLEAN_POLICY
+                try:
+                    if not should_retain(record, policy, settings.RETENTION_SAMPLE_EVERY):
+                        stat = storage.client.stat_object(bucket_name, object_name)
+                        db.add(FrameShardIndex(storage_path=record.storage_path, status="dropped", length=stat.size))
+                        dropped_sizes[record.storage_path] = stat.size
+                        report["frames_dropped"] += 1
+                        continue
+                    response = storage.client.get_object(bucket_name, object_name)
+                    try:
+                        data = response.read()
+                        content_type = response.headers.get("Content-Type")
+                    finally:
+                        response.close()
+                        response.release_conn()
+                except S3Error as e:
+                    if e.code != "NoSuchKey":
+                        raise
+                    # 原始物件已不存在，記一筆索引避免每次重掃
+                    print(f"⚠️ [Compaction] 找不到物件，略過: {record.storage_path}")
+                    db.add(FrameShardIndex(storage_path=record.storage_path, status="missing", length=0))
+                    report["frames_missing"] += 1
+                    continue
+                if writer is None:
+                    writer = ShardWriter(storage, settings.MINIO_SHARD_BUCKET_NAME)
+                    writer_first_id = record.id
+                writer.append(record.storage_path, data, content_type)
+                report["frames_packed"] += 1
+                report["bytes_packed"] += len(data)
+                if writer.size >= settings.COMPACTION_SHARD_TARGET_BYTES:
+                    flush_shard()
+                    writer = None
+                    writer_first_id = None
+            # 先 commit 刪除紀錄與進度，再真正刪除物件
+            save_checkpoint(last_id)
+            db.commit()
+            failed = set(remove_raw(list(dropped_sizes)))
+            report["bytes_reclaimed"] += sum(size for path, size in dropped_sizes.items() if path not in failed)
+        if writer is not None and writer.entries:
+            flush_shard()
+            writer = None
+            writer_first_id = None
+            save_checkpoint(last_id)
+            db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+    print(f"✅ [Compaction] 完成: {report}")
+    return report
@@ -1,7 +1,9 @@
 from minio import Minio
+from minio.deleteobjects import DeleteObject
 from minio.error import S3Error
 import io
 from ..config import settings
+from ..models import SessionLocal, FrameShardIndex
 
 class StorageService:
     def __init__(self):
@@ -15,12 +17,12 @@ class StorageService:
         )
         self._ensure_bucket_exists()
 
-    def _ensure_bucket_exists(self):
+    def _ensure_bucket_exists(self, bucket_name: str = settings.MINIO_BUCKET_NAME):
         """確認 Bucket 存在，不存在就建立 (企業級容錯)"""
         try:
-            if not self.client.bucket_exists(settings.MINIO_BUCKET_NAME):
-                self.client.make_bucket(settings.MINIO_BUCKET_NAME)
-                print(f"Bucket '{settings.MINIO_BUCKET_NAME}' created.")
+            if not self.client.bucket_exists(bucket_name):
+                self.client.make_bucket(bucket_name)
+                print(f"Bucket '{bucket_name}' created.")
         except S3Error as e:
             print(f"MinIO Error: {e}")
 
@@ -41,6 +43,56 @@ class StorageService:
             print(f"Upload Failed: {e}")
             raise e
 
+    def read_file(self, storage_path: str, resolve_shards: bool = True) -> bytes:
+        """
+        依 DB 的 storage_path 讀取影像。
+        已被封存的影像會透過 Shard 索引改用 Range Read (offset + length) 讀取。
+        resolve_shards=False 直接讀原始物件，不查 DB (給只處理新影像的 AI Worker 用)。
+        """
+        if not resolve_shards:
+            bucket_name, object_name = storage_path.split("/", 1)
+            return self._read_object(bucket_name, object_name)
+        db = SessionLocal()
+        try:
+            entry = db.query(FrameShardIndex).filter(FrameShardIndex.storage_path == storage_path).first()
+        finally:
+            db.close()
+        if entry is None:
+            bucket_name, object_name = storage_path.split("/", 1)
+            return self._read_object(bucket_name, object_name)
+        if entry.status == "dropped":
+            raise FileNotFoundError(f"Frame removed by retention policy: {storage_path}")
+        if entry.status == "missing":
+            raise FileNotFoundError(f"Frame object was already missing at compaction time: {storage_path}")
+        # length=0 時 MinIO 不會送 Range header，會回傳整個 Shard，這裡直接短路
+        if entry.length == 0:
+            return b""
+        bucket_name, object_name = entry.shard_path.split("/", 1)
+        return self._read_object(bucket_name, object_name, offset=entry.offset, length=entry.length)
+
+    def _read_object(self, bucket_name: str, object_name: str, offset: int = 0, length: int = 0) -> bytes:
+        """讀取物件；offset / length 皆為 0 時讀整個物件"""
+        response = self.client.get_object(bucket_name, object_name, offset=offset, length=length)
+        try:
+            return response.read()
+        finally:
+            response.close()
+            response.release_conn()
+
+    def remove_files(self, storage_paths: list) -> list:
+        """批次刪除物件 (同一 Bucket 一次送出)，回傳刪除失敗的路徑"""
+        by_bucket = {}
+        for path in storage_paths:
+            bucket_name, object_name = path.split("/", 1)
+            by_bucket.setdefault(bucket_name, []).append(object_name)
+        failed = []
+        for bucket_name, object_names in by_bucket.items():
+            # remove_objects 是 lazy iterator，必須走訪才會真正送出刪除請求
+            for error in self.client.remove_objects(bucket_name, [DeleteObject(name) for name in object_names]):
+                print(f"Remove Failed: {error}")
+                failed.append(f"{bucket_name}/{error.name}")
+        return failed
+
 # 定義一個全域變數來存放單例，但初始為 None
 _storage_client_instance = None
 
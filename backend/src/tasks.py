@@ -1,7 +1,7 @@
 from celery import Task
 from .celery_app import celery_app
 from .services.storage import get_storage_client
-from .models import SessionLocal, InspectionResult, init_db
+from .models import SessionLocal, InspectionResult, InspectionDetection, init_db
 from ultralytics import YOLO
 import cv2
 import numpy as np
@@ -32,7 +32,7 @@ except Exception as e:
     print(f"⚠️ 模型預熱失敗: {e}")
 
 @celery_app.task(name="detect_task", bind=True, time_limit=60)
-def detect_image_task(self, file_name: str, storage_path: str, created_at_ts: float):
+def detect_image_task(self, file_name: str, storage_path: str, created_at_ts: float, line: str = None):
     storage_client = get_storage_client()
     if not storage_client:
         # 處理重試或錯誤
@@ -51,31 +51,13 @@ def detect_image_task(self, file_name: str, storage_path: str, created_at_ts: fl
         # 簡單解析 bucket 和 object
         if "/" not in storage_path:
             return {"status": "error", "reason": f"無效的 storage_path: {storage_path}"}
-        bucket_name, object_name = storage_path.split("/", 1)
-        print(f"📦 解析結果: bucket={bucket_name}, object={object_name}")
-        # 測試連接
-        try:
-            exists = storage_client.bucket_exists(bucket_name)
-            print(f"🔍 Bucket 存在: {exists}")
-            if not exists:
-                return {"status": "error", "reason": f"Bucket 不存在: {bucket_name}"}
-        except Exception as e:
-            print(f"❌ Bucket 檢查失敗: {e}")
-            return {"status": "error", "reason": f"Bucket 檢查失敗: {str(e)}"}
-        # 下載對象
+        # 下載對象：剛上傳的影像不可能已被封存 (只封存超過 24 小時的影像)，不查 Shard 索引以省下 DB 往返
         print(f"⬇️ 開始下載...")
-        response = storage_client.get_object(bucket_name, object_name)
-        print(f"✅ 獲取響應成功")
-        # 讀取數據
-        data = response.read()
+        data = storage_client.read_file(storage_path, resolve_shards=False)
         print(f"📊 讀取數據大小: {len(data)} 字節")
         # 轉換
         file_bytes = np.frombuffer(data, dtype=np.uint8)
         print(f"🔄 轉換為 numpy array")
-        # 關閉響應
-        response.close()
-        response.release_conn()
-        print(f"🔒 響應已關閉")
         # 解碼圖片
         img = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
         if img is None:
@@ -121,13 +103,21 @@ def detect_image_task(self, file_name: str, storage_path: str, created_at_ts: fl
         return {"status": "error", "reason": f"YOLO 推理失敗: {str(e)}"}
     # 4. 寫入資料庫
     print(f"💾 寫入資料庫...")
+    created_at = datetime.utcnow()
     db = SessionLocal()
     try:
         record = InspectionResult(
             task_id=self.request.id,
             filename=file_name,
             storage_path=storage_path,
-            inference_result=json.dumps(detections, ensure_ascii=False)
+            inference_result=json.dumps(detections, ensure_ascii=False),
+            created_at=created_at,
+            line=line,
+            # 每個偵測結果另存一筆，供歷史查詢以索引篩選類別與信心度
+            detections=[
+                InspectionDetection(label=d["label"], confidence=d["confidence"], created_at=created_at, line=line)
+                for d in detections
+            ]
         )
         db.add(record)
         db.commit()
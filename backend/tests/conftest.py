@@ -0,0 +1,13 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from src.models import Base
+
+@pytest.fixture
+def session_factory():
+    # 用 in-memory SQLite 取代 PostgreSQL (StaticPool 讓多個 Session 共用同一個連線)
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    yield sessionmaker(bind=engine)
+    engine.dispose()
@@ -0,0 +1,186 @@
+from unittest.mock import patch, MagicMock
+from datetime import datetime, timedelta
+import json
+import pytest
+from src.models import InspectionResult, FrameShardIndex, CompactionCheckpoint
+from src.services.compaction import compact_raw_images
+from src.services.storage import StorageService
+
+def make_storage(objects):
+    # 模擬 MinIO：objects 是 {storage_path: bytes}
+    storage = MagicMock()
+    def get_object(bucket_name, object_name):
+        response = MagicMock()
+        response.read.return_value = objects[f"{bucket_name}/{object_name}"]
+        response.headers = {"Content-Type": "image/jpeg"}
+        return response
+    def stat_object(bucket_name, object_name):
+        return MagicMock(size=len(objects[f"{bucket_name}/{object_name}"]))
+    def put_object(bucket_name, object_name, data, length, content_type):
+        objects[f"{bucket_name}/{object_name}"] = data.read(length)
+    storage.client.get_object.side_effect = get_object
+    storage.client.stat_object.side_effect = stat_object
+    storage.client.put_object.side_effect = put_object
+    storage.remove_files.return_value = []
+    return storage
+
+def configure_settings(mock_settings):
+    mock_settings.MINIO_SHARD_BUCKET_NAME = "raw-shards"
+    mock_settings.COMPACTION_MIN_AGE_HOURS = 24
+    mock_settings.COMPACTION_SHARD_TARGET_BYTES = 1024
+    mock_settings.COMPACTION_BATCH_SIZE = 2
+    mock_settings.COMPACTION_CHECKPOINT_MARGIN_MINUTES = 30
+    mock_settings.RETENTION_DEFECT_POLICY = "keep"
+    mock_settings.RETENTION_CLEAN_POLICY = "downsample"
+    mock_settings.RETENTION_SAMPLE_EVERY = 2
+
+def add_frames(session_factory, objects, frames, created_at):
+    # frames: [(id, detections)]
+    db = session_factory()
+    for i, detections in frames:
+        path = f"raw-images/frame-{i}.jpg"
+        objects[path] = f"image-{i}".encode()
+        db.add(InspectionResult(
+            id=i,
+            task_id=f"task-{i}",
+            filename=f"frame-{i}.jpg",
+            storage_path=path,
+            inference_result=json.dumps(detections),
+            created_at=created_at
+        ))
+    db.commit()
+    db.close()
+
+@patch("src.services.compaction.settings")
+def test_compact_packs_defects_and_downsamples_clean(mock_settings, session_factory):
+    configure_settings(mock_settings)
+    old = datetime.utcnow() - timedelta(days=2)
+    objects = {}
+    # id 1, 4: 瑕疵；id 2, 3: 良品；id 5: 太新不處理
+    add_frames(session_factory, objects, [(1, [{"label": "scratch"}]), (2, []), (3, []), (4, [{"label": "crack"}])], old)
+    add_frames(session_factory, objects, [(5, [])], datetime.utcnow())
+    storage = make_storage(objects)
+    report = compact_raw_images(storage, session_factory=session_factory)
+    # 驗證統計：1, 4 (瑕疵) 與 2 (良品取樣) 打包，3 刪除
+    assert report["frames_scanned"] == 4
+    assert report["frames_packed"] == 3
+    assert report["frames_dropped"] == 1
+    assert report["shards_written"] == 1
+    assert report["objects_removed"] == 4
+    assert report["bytes_reclaimed"] == len(objects["raw-images/frame-3.jpg"])
+    # 驗證 Shard 內容與索引 offset 對得上
+    shard_path = f"raw-shards/{storage.client.put_object.call_args_list[0].kwargs['object_name']}"
+    db = session_factory()
+    entries = {e.storage_path: e for e in db.query(FrameShardIndex).all()}
+    db.close()
+    assert entries["raw-images/frame-3.jpg"].status == "dropped"
+    assert "raw-images/frame-5.jpg" not in entries
+    for i in (1, 2, 4):
+        entry = entries[f"raw-images/frame-{i}.jpg"]
+        assert entry.shard_path == shard_path
+        assert objects[shard_path][entry.offset:entry.offset + entry.length] == objects[f"raw-images/frame-{i}.jpg"]
+    # 重跑不應重複處理
+    report = compact_raw_images(storage, session_factory=session_factory)
+    assert report["frames_scanned"] == 0
+
+@patch("src.services.compaction.settings")
+def test_compact_resumes_from_checkpoint_and_reports_remove_failures(mock_settings, session_factory):
+    configure_settings(mock_settings)
+    mock_settings.RETENTION_CLEAN_POLICY = "drop"
+    old = datetime.utcnow() - timedelta(days=2)
+    objects = {}
+    add_frames(session_factory, objects, [(1, []), (2, [])], old)
+    storage = make_storage(objects)
+    # 刪除 frame-1 一直失敗
+    storage.remove_files.side_effect = lambda paths: [p for p in paths if p == "raw-images/frame-1.jpg"]
+    report = compact_raw_images(storage, session_factory=session_factory)
+    assert report["frames_dropped"] == 2
+    assert report["objects_removed"] == 1
+    assert report["remove_failed"] == ["raw-images/frame-1.jpg"]
+    # 刪除失敗的 frame-1 不算回收空間
+    assert report["bytes_reclaimed"] == len(objects["raw-images/frame-2.jpg"])
+    # 清掉索引：若沒有進度紀錄，id 1, 2 會被重新掃描
+    db = session_factory()
+    assert db.get(CompactionCheckpoint, "raw-images").last_id == 2
+    db.query(FrameShardIndex).delete()
+    db.commit()
+    db.close()
+    # 新資料只會從進度之後開始掃
+    add_frames(session_factory, objects, [(3, [])], old)
+    storage.remove_files.side_effect = None
+    report = compact_raw_images(storage, session_factory=session_factory)
+    assert report["frames_scanned"] == 1
+    assert report["remove_failed"] == []
+
+@patch("src.services.compaction.settings")
+def test_compact_checkpoint_keeps_margin_for_out_of_order_created_at(mock_settings, session_factory):
+    configure_settings(mock_settings)
+    mock_settings.RETENTION_CLEAN_POLICY = "drop"
+    now = datetime.utcnow()
+    cutoff = now - timedelta(hours=24)
+    objects = {}
+    # id 2 的 created_at 比 id 3 晚 (多 Worker 時可能發生)，第一次執行時 id 2 還沒到期
+    add_frames(session_factory, objects, [(1, [])], cutoff - timedelta(days=1))
+    add_frames(session_factory, objects, [(2, [])], cutoff + timedelta(minutes=1))
+    add_frames(session_factory, objects, [(3, [])], cutoff - timedelta(minutes=1))
+    storage = make_storage(objects)
+    report = compact_raw_images(storage, session_factory=session_factory, now=now)
+    assert report["frames_scanned"] == 2
+    # id 3 在安全邊界內，進度只推進到 id 1
+    db = session_factory()
+    assert db.get(CompactionCheckpoint, "raw-images").last_id == 1
+    db.close()
+    # 下一次執行仍會掃到 id 2
+    report = compact_raw_images(storage, session_factory=session_factory, now=now + timedelta(minutes=5))
+    assert report["frames_scanned"] == 1
+    db = session_factory()
+    assert db.query(FrameShardIndex).filter(FrameShardIndex.storage_path == "raw-images/frame-2.jpg").count() == 1
+    db.close()
+
+def make_storage_service(session_factory, entries):
+    # 不連線 MinIO，直接建立 StorageService 並換上 Mock client
+    db = session_factory()
+    db.add_all(entries)
+    db.commit()
+    db.close()
+    service = StorageService.__new__(StorageService)
+    service.client = MagicMock()
+    service.client.get_object.return_value.read.return_value = b"frame-bytes"
+    return service
+
+def test_read_file_packed_uses_range_read(session_factory):
+    service = make_storage_service(session_factory, [
+        FrameShardIndex(storage_path="raw-images/a.jpg", status="packed", shard_path="raw-shards/shard-1.bin", offset=128, length=11),
+        FrameShardIndex(storage_path="raw-images/empty.jpg", status="packed", shard_path="raw-shards/shard-1.bin", offset=139, length=0)
+    ])
+    with patch("src.services.storage.SessionLocal", session_factory):
+        assert service.read_file("raw-images/a.jpg") == b"frame-bytes"
+        service.client.get_object.assert_called_once_with("raw-shards", "shard-1.bin", offset=128, length=11)
+        # 0 byte 的影像不能送出沒有 Range 的請求 (會讀回整個 Shard)
+        assert service.read_file("raw-images/empty.jpg") == b""
+        assert service.client.get_object.call_count == 1
+
+def test_read_file_not_packed_reads_raw_object(session_factory):
+    service = make_storage_service(session_factory, [])
+    with patch("src.services.storage.SessionLocal", session_factory):
+        assert service.read_file("raw-images/new.jpg") == b"frame-bytes"
+    service.client.get_object.assert_called_once_with("raw-images", "new.jpg", offset=0, length=0)
+
+def test_read_file_without_shard_resolution_skips_db():
+    service = make_storage_service(MagicMock(), [])
+    with patch("src.services.storage.SessionLocal") as mock_session_local:
+        assert service.read_file("raw-images/new.jpg", resolve_shards=False) == b"frame-bytes"
+    mock_session_local.assert_not_called()
+    service.client.get_object.assert_called_once_with("raw-images", "new.jpg", offset=0, length=0)
+
+def test_read_file_dropped_or_missing_raises(session_factory):
+    service = make_storage_service(session_factory, [
+        FrameShardIndex(storage_path="raw-images/dropped.jpg", status="dropped", length=10),
+        FrameShardIndex(storage_path="raw-images/missing.jpg", status="missing", length=0)
+    ])
+    with patch("src.services.storage.SessionLocal", session_factory):
+        with pytest.raises(FileNotFoundError, match="retention policy"):
+            service.read_file("raw-images/dropped.jpg")
+        with pytest.raises(FileNotFoundError, match="already missing"):
+            service.read_file("raw-images/missing.jpg")
+    service.client.get_object.assert_not_called()
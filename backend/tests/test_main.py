@@ -1,6 +1,14 @@
 from fastapi.testclient import TestClient
 from unittest.mock import patch, MagicMock
-from src.main import app
+from datetime import datetime, timedelta
+import numpy as np
+import json
+import pytest
+import time
+from sqlalchemy import text
+from src.main import app, _label_match_query
+from src.models import InspectionResult, InspectionDetection
+from src.tasks import detect_image_task
 
 client = TestClient(app)
 @patch("src.main.get_storage_client")
@@ -31,4 +39,128 @@ def test_upload_and_detect(mock_send_task, mock_get_storage_client):
     assert "filename" in resp_json
     # 驗證是否正確呼叫
     mock_get_storage_client.assert_called()
-    mock_storage_instance.upload_file.assert_called_once()
\ No newline at end of file
+    mock_storage_instance.upload_file.assert_called_once()
+
+@patch("src.main.get_storage_client")
+@patch("src.main.detect_image_task")
+def test_upload_and_detect_passes_line(mock_detect_task, mock_get_storage_client):
+    mock_get_storage_client.return_value.upload_file.return_value = "raw-images/test.jpg"
+    mock_detect_task.delay.return_value.id = "test-task-id-456"
+    files = {"file": ("test.jpg", b"fake image content", "image/jpeg")}
+    response = client.post("/api/v1/detect", files=files, data={"line": "L1"})
+    assert response.status_code == 200
+    # 產線代號要傳進 Worker
+    args = mock_detect_task.delay.call_args.args
+    assert args[1] == "raw-images/test.jpg"
+    assert args[3] == "L1"
+
+@patch("src.tasks.get_storage_client")
+@patch("src.tasks.model")
+@patch("src.tasks.cv2.imdecode")
+def test_detect_task_saves_line_and_detections(mock_imdecode, mock_model, mock_get_storage_client, session_factory):
+    mock_get_storage_client.return_value.read_file.return_value = b"fake image content"
+    mock_imdecode.return_value = np.zeros((8, 8, 3), dtype=np.uint8)
+    # 模擬 YOLO 回傳兩個 bbox
+    boxes = []
+    for cls, conf in ((0, 0.9), (1, 0.8)):
+        box = MagicMock()
+        box.xyxy = [MagicMock(tolist=MagicMock(return_value=[0, 0, 4, 4]))]
+        box.conf = [conf]
+        box.cls = [cls]
+        boxes.append(box)
+    mock_model.return_value = [MagicMock(boxes=boxes)]
+    mock_model.names = {0: "crack", 1: "scratch"}
+    with patch("src.tasks.SessionLocal", session_factory):
+        result = detect_image_task("test.jpg", "raw-images/test.jpg", time.time(), "L1")
+    assert result["status"] == "success"
+    # Worker 讀新影像不查 Shard 索引
+    mock_get_storage_client.return_value.read_file.assert_called_once_with("raw-images/test.jpg", resolve_shards=False)
+    db = session_factory()
+    record = db.query(InspectionResult).one()
+    assert record.line == "L1"
+    assert sorted((d.label, d.confidence) for d in record.detections) == [("crack", 0.9), ("scratch", 0.8)]
+    db.close()
+
+@pytest.fixture
+def inspection_db(session_factory):
+    # 5 筆紀錄 (id 越大越新)；奇數 id 有 crack 0.9 + scratches 0.6 兩個偵測結果
+    db = session_factory()
+    base_time = datetime(2024, 1, 1)
+    for i in range(1, 6):
+        detections = [{"label": "crack", "confidence": 0.9}, {"label": "scratches", "confidence": 0.6}] if i % 2 else []
+        created_at = base_time + timedelta(minutes=i)
+        line = "L1" if i <= 3 else "L2"
+        db.add(InspectionResult(
+            id=i,
+            task_id=f"task-{i}",
+            filename=f"frame-{i}.jpg",
+            storage_path=f"raw-images/frame-{i}.jpg",
+            inference_result=json.dumps(detections),
+            line=line,
+            created_at=created_at,
+            detections=[
+                InspectionDetection(label=d["label"], confidence=d["confidence"], created_at=created_at, line=line)
+                for d in detections
+            ]
+        ))
+    db.commit()
+    db.close()
+    with patch("src.main.SessionLocal", session_factory):
+        yield
+
+def test_list_inspections_keyset_pagination(inspection_db):
+    # 第一頁
+    response = client.get("/api/v1/inspections", params={"limit": 2})
+    assert response.status_code == 200
+    page = response.json()
+    assert [item["id"] for item in page["items"]] == [5, 4]
+    # 預設不回傳 inference_result
+    assert "inference_result" not in page["items"][0]
+    # 用 cursor 往後翻頁直到結束
+    ids = [item["id"] for item in page["items"]]
+    while page["next_cursor"]:
+        page = client.get("/api/v1/inspections", params={"limit": 2, "cursor": page["next_cursor"]}).json()
+        ids += [item["id"] for item in page["items"]]
+    assert ids == [5, 4, 3, 2, 1]
+
+def test_list_inspections_filters_and_projection(inspection_db):
+    # 非最高信心度的類別也要查得到
+    params = {"label": "scratches", "min_confidence": 0.5, "line": "L1", "fields": "id,inference_result"}
+    response = client.get("/api/v1/inspections", params=params)
+    assert response.status_code == 200
+    items = response.json()["items"]
+    assert [item["id"] for item in items] == [3, 1]
+    assert set(items[0].keys()) == {"id", "inference_result"}
+    assert items[0]["inference_result"][1]["label"] == "scratches"
+    # label 與 min_confidence 需套用在同一個偵測結果 (scratches 只有 0.6)
+    response = client.get("/api/v1/inspections", params={"label": "scratches", "min_confidence": 0.8})
+    assert response.json()["items"] == []
+    # 不存在的欄位與壞掉的 cursor 回傳 400
+    assert client.get("/api/v1/inspections", params={"fields": "id,password"}).status_code == 400
+    assert client.get("/api/v1/inspections", params={"cursor": "not-a-cursor"}).status_code == 400
+
+def test_list_inspections_label_pages(inspection_db):
+    # 依類別查詢也是 keyset 分頁
+    page = client.get("/api/v1/inspections", params={"label": "crack", "limit": 2}).json()
+    assert [item["id"] for item in page["items"]] == [5, 3]
+    page = client.get("/api/v1/inspections", params={"label": "crack", "limit": 2, "cursor": page["next_cursor"]}).json()
+    assert [item["id"] for item in page["items"]] == [1]
+    assert page["next_cursor"] is None
+
+def test_label_match_query_uses_label_index(session_factory):
+    # 依類別查詢必須走 (label, created_at, inspection_id) 索引，而不是倒著掃整張 inspection_results
+    db = session_factory()
+    criteria = {"since": None, "until": None, "label": "crack", "min_confidence": 0.5, "line": None}
+    query = _label_match_query(db, criteria, (datetime(2024, 1, 1), 10), 50)
+    sql = str(query.statement.compile(db.get_bind(), compile_kwargs={"literal_binds": True}))
+    plan = " ".join(str(row[-1]) for row in db.execute(text(f"EXPLAIN QUERY PLAN {sql}")))
+    db.close()
+    assert "ix_inspection_detections_label_created_at_inspection_id" in plan
+    assert "TEMP B-TREE" not in plan
+
+def test_list_inspections_ndjson_stream(inspection_db):
+    response = client.get("/api/v1/inspections", params={"format": "ndjson", "since": "2024-01-01T00:02:00"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [item["id"] for item in lines] == [5, 4, 3, 2]
@@ -0,0 +1,41 @@
+from datetime import datetime
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.pool import StaticPool
+import json
+from src.models import InspectionResult, InspectionDetection, add_missing_columns
+from src.migrations import backfill_detections
+
+def test_add_missing_columns_upgrades_old_schema():
+    # 舊版資料表沒有 line 欄位
+    engine = create_engine("sqlite://", poolclass=StaticPool)
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE inspection_results (id INTEGER PRIMARY KEY, task_id VARCHAR, filename VARCHAR, "
+            "storage_path VARCHAR, inference_result JSON, created_at DATETIME)"
+        ))
+    add_missing_columns(engine)
+    # 可重複執行
+    add_missing_columns(engine)
+    assert "line" in {column["name"] for column in inspect(engine).get_columns("inspection_results")}
+
+def test_backfill_detections_from_inference_result(session_factory):
+    db = session_factory()
+    # id 1: 舊資料 (只有 JSON)；id 2: 良品；id 3: 新資料 (Worker 已寫入偵測結果)
+    db.add(InspectionResult(id=1, storage_path="raw-images/1.jpg", created_at=datetime(2024, 1, 1),
+                            inference_result=json.dumps([{"label": "crack", "confidence": 0.9}, {"label": "scratch", "confidence": 0.8}])))
+    db.add(InspectionResult(id=2, storage_path="raw-images/2.jpg", created_at=datetime(2024, 1, 1),
+                            inference_result=json.dumps([])))
+    db.add(InspectionResult(id=3, storage_path="raw-images/3.jpg", created_at=datetime(2024, 1, 1),
+                            inference_result=json.dumps([{"label": "crack", "confidence": 0.7}]),
+                            detections=[InspectionDetection(label="crack", confidence=0.7, created_at=datetime(2024, 1, 1))]))
+    db.commit()
+    db.close()
+    assert backfill_detections(session_factory) == 2
+    # 可重複執行，不會重複寫入
+    assert backfill_detections(session_factory) == 0
+    db = session_factory()
+    rows = db.query(InspectionDetection.inspection_id, InspectionDetection.label).all()
+    # 回填的偵測結果帶有紀錄的 created_at (依類別分頁需要)
+    assert db.query(InspectionDetection).filter(InspectionDetection.created_at.is_(None)).count() == 0
+    db.close()
+    assert sorted(rows) == [(1, "crack"), (1, "scratch"), (3, "crack")]